@@ -5,132 +5,312 @@ date: 2025-09-30
 version: 1.0
 license: MIT
 description: Logs prompts and responses to console in a dedicated audit-log JSON format.
+requirements: orjson
 """
 
 from utils.pipelines.main import get_last_assistant_message, get_last_user_message
 from typing import List, Optional, Any
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from datetime import datetime, timezone
 
 import os
+import sys
 import json
 import uuid
-import traceback
+import queue
+import logging
+import threading
+import collections
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Note on optimization strategy: this filter is dict manipulation plus
+# stdout I/O, not numeric loops, so a JIT such as Numba does not apply
+# (and would regress import time). The hot path is instead covered by
+# orjson for CPU-bound serialization and the background writer thread
+# below for batched I/O.
+
+# Cached tzinfo; avoids the timezone.utc attribute lookup per log line
+_UTC = timezone.utc
+
+# Max number of log lines coalesced into a single stdout write
+_BUFFER_SIZE = int(os.getenv("AUDIT_LOG_BUFFER_SIZE", "8000"))
+
+# Upper bound on queued-but-unwritten log lines; when stdout applies
+# backpressure and the queue fills up, callers write inline instead
+_QUEUE_SIZE = int(os.getenv("AUDIT_LOG_QUEUE_SIZE", "65536"))
+
+# Pre-generated fallback-id pool; refilled off the request path
+_UUID_POOL_SIZE = 1024
+_UUID_POOL_LOW_WATER = 256
+
+# Environment is read once at import; Valves defaults reference these
+# constants instead of hitting os.environ on every instantiation.
+_SERVICE_NAME = os.environ.get("AUDIT_LOG_SERVICE_NAME", "open-webui")
+_SERVICE_VERSION = os.environ.get("AUDIT_LOG_SERVICE_VERSION", "")
+_ENVIRONMENT = os.environ.get("AUDIT_LOG_ENVIRONMENT", "")
+_PIPELINES = os.environ.get("AUDIT_LOG_PIPELINES", "*").split(",")
 
 
 def _extract_text(content: Any) -> str:
-    if isinstance(content, str):
+    # Exact type() checks skip the MRO walk isinstance does; message bodies
+    # are plain str/list/dict coming off the wire, never subclasses.
+    t = type(content)
+    if t is str:
         return content
-    if isinstance(content, list):
+    if t is list:
         parts: List[str] = []
+        parts_append = parts.append
         for part in content:
-            if isinstance(part, str):
-                parts.append(part)
-            elif isinstance(part, dict):
+            pt = type(part)
+            if pt is str:
+                parts_append(part)
+            elif pt is dict:
                 text = part.get("text") or part.get("content")
-                if isinstance(text, str):
-                    parts.append(text)
+                if type(text) is str:
+                    parts_append(text)
         return "".join(parts)
     return ""
 
 
 class Pipeline:
+    # Fixed attribute set: slot reads skip the instance __dict__ lookup on
+    # the hot path. The server only ever assigns `valves` from outside.
+    __slots__ = (
+        "type",
+        "name",
+        "valves",
+        "_static_prefix",
+        "_include_content",
+        "_use_external_ip",
+        "_queue",
+        "_writer",
+        "_uuid_pool",
+        "_uuid_refill_lock",
+    )
+
     class Valves(BaseModel):
-        pipelines: List[str] = ["*"]
+        model_config = ConfigDict(frozen=True)
+
+        pipelines: List[str] = _PIPELINES
         priority: int = 0
 
         # Static service metadata
-        service_name: str = os.getenv("AUDIT_LOG_SERVICE_NAME", "open-webui")
-        service_version: str = os.getenv("AUDIT_LOG_SERVICE_VERSION", "")
-        environment: str = os.getenv("AUDIT_LOG_ENVIRONMENT", "")
+        service_name: str = _SERVICE_NAME
+        service_version: str = _SERVICE_VERSION
+        environment: str = _ENVIRONMENT
 
         # Whether to include content (prompt/response) in logs
         include_content: bool = True
 
+        # Whether to resolve the caller IP from the user record instead of
+        # logging an empty caller-ip field
+        use_external_ip: bool = False
+
     def __init__(self):
         self.type = "filter"
         self.name = "Audit Log Filter"
 
-        self.valves = self.Valves(
-            **{
-                "pipelines": os.getenv("AUDIT_LOG_PIPELINES", "*").split(","),
-            }
-        )
+        self.valves = self.Valves()
+        self._refresh_from_valves()
+
+        # Log lines are handed off to a background writer so inlet/outlet
+        # never block on a stdout syscall; the worker coalesces queued
+        # lines into a single write. The queue is bounded so a stalled
+        # stdout cannot grow the backlog without limit.
+        self._queue = queue.Queue(maxsize=_QUEUE_SIZE)
+        self._writer = threading.Thread(target=self._drain_loop, daemon=True)
+        self._writer.start()
+
+        # Fallback ids are drawn from a pre-generated pool so the request
+        # path avoids the urandom read + UUID formatting of uuid4()
+        self._uuid_pool = collections.deque()
+        self._uuid_refill_lock = threading.Lock()
+
+    def _refill_uuid_pool(self):
+        try:
+            pool = self._uuid_pool
+            while len(pool) < _UUID_POOL_SIZE:
+                pool.append(str(uuid.uuid4()))
+        finally:
+            self._uuid_refill_lock.release()
+
+    def _next_uuid(self) -> str:
+        pool = self._uuid_pool
+        if len(pool) < _UUID_POOL_LOW_WATER and self._uuid_refill_lock.acquire(
+            blocking=False
+        ):
+            threading.Thread(target=self._refill_uuid_pool, daemon=True).start()
+        try:
+            return pool.popleft()
+        except IndexError:
+            return str(uuid.uuid4())
+
+    def _build_static_prefix(self) -> bytes:
+        # The fixed fields of every log line, serialized once with the
+        # trailing brace stripped; _print_log splices the per-request
+        # fields onto it instead of re-encoding these keys each call.
+        static = {
+            "log-type": "audit",
+            "service-name": self.valves.service_name,
+            "service-version": self.valves.service_version,
+            "environment": self.valves.environment,
+            "audit-log-type": "access",
+        }
+        if not self.valves.use_external_ip:
+            static["caller-ip"] = ""
+        if orjson is not None:
+            return orjson.dumps(static)[:-1]
+        return json.dumps(static, ensure_ascii=False).encode()[:-1]
+
+    def _refresh_from_valves(self):
+        # Derived valve state. The server replaces self.valves wholesale
+        # both from the /valves/update endpoint (which calls
+        # on_valves_updated) and from valves.json at startup (which does
+        # not), so this must run from __init__, on_startup and
+        # on_valves_updated alike.
+        self._include_content = self.valves.include_content
+        self._use_external_ip = self.valves.use_external_ip
+        self._static_prefix = self._build_static_prefix()
+
+    async def on_valves_updated(self):
+        self._refresh_from_valves()
+
+    def _drain_loop(self):
+        while True:
+            entry = self._queue.get()
+            stop = entry is None
+            lines = [] if stop else [entry]
+            try:
+                while len(lines) < _BUFFER_SIZE:
+                    entry = self._queue.get_nowait()
+                    if entry is None:
+                        stop = True
+                        break
+                    lines.append(entry)
+            except queue.Empty:
+                pass
+            if lines:
+                sys.stdout.buffer.write(b"\n".join(lines) + b"\n")
+                sys.stdout.buffer.flush()
+            if stop:
+                break
 
     async def on_startup(self):
         print(f"on_startup:{__name__}")
+        # valves were just overwritten from valves.json without going
+        # through on_valves_updated
+        self._refresh_from_valves()
+        if self._uuid_refill_lock.acquire(blocking=False):
+            threading.Thread(target=self._refill_uuid_pool, daemon=True).start()
 
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
+        # Flush any queued log lines before the worker exits. If the queue
+        # is full the writer is wedged on stdout anyway; skip the sentinel
+        # rather than blocking the event loop, and let the join time out.
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self._writer.join(timeout=5)
 
     def _base_log(self, body: dict, __user__: Optional[dict]) -> dict:
-        now = datetime.now(timezone.utc).isoformat()
-        user = __user__["email"]
-        # Prefer explicit chat identifiers if present
+        # Kept as a datetime; orjson serializes it natively (see _print_log)
+        now = datetime.now(_UTC)
+        u = __user__ or {}
+        email = u.get("email")
+        # Prefer explicit chat identifiers if present; fall back to the user
+        # id (not the email string, which has no .get and used to raise here)
         trace_id = (
             body.get("chat_id")
             or body.get("metadata", {}).get("chat_id")
             or body.get("session_id")
-            or (user.get("id") if user else None)
-            or str(uuid.uuid4())
+            or u.get("id")
+            or self._next_uuid()
         )
 
-        # Extract and store both model name and ID if available
-        model_id = body.get("model")
-
-        return {
-            "log-type": "audit",
+        # Only the per-request fields; the static portion lives in the
+        # preserialized prefix (see _build_static_prefix)
+        out = {
             "timestamp": now,
             "trace-id": trace_id,
-            "service-name": self.valves.service_name,
-            "service-version": self.valves.service_version,
-            "environment": self.valves.environment,
-            "audit-log-type": "access",
-            "caller-ip": "",
-            "subject-id": user,
-            "owner-id": user,
-            "resource-type": model_id,
+            "subject-id": email,
+            "owner-id": email,
+            "resource-type": body.get("model"),
         }
+        if self._use_external_ip:
+            out["caller-ip"] = u.get("ip") or ""
+        return out
 
     def _print_log(self, payload: dict):
         try:
-            print(json.dumps(payload, ensure_ascii=False))
+            if orjson is not None:
+                # orjson returns bytes and is non-ASCII-safe by default
+                dynamic = orjson.dumps(payload, option=orjson.OPT_UTC_Z)
+            else:
+                # isoformat keeps the stdlib path on ISO-8601 like orjson;
+                # default=str would render datetimes with a space separator
+                dynamic = json.dumps(
+                    payload, ensure_ascii=False, default=lambda d: d.isoformat()
+                ).encode()
+            # Splice the dynamic object (minus its opening brace) onto the
+            # preserialized static prefix; escaping stays with the encoder
+            line = self._static_prefix + b"," + dynamic[1:]
+            try:
+                self._queue.put_nowait(line)
+            except queue.Full:
+                # Writer has fallen behind; take the backpressure inline
+                # rather than dropping the audit line or growing memory
+                sys.stdout.buffer.write(line + b"\n")
         except Exception as e:
             # Fallback to a minimal safe representation
             print(json.dumps({"audit-log-error": str(e)}))
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         try:
-            metadata = body.get("metadata", {})
-            chat_id = metadata.get("chat_id", str(uuid.uuid4()))
+            metadata = body.get("metadata")
+            if metadata is None:
+                metadata = {}
+                body["metadata"] = metadata
+            chat_id = metadata.get("chat_id")
+            if chat_id is None:
+                chat_id = self._next_uuid()
 
             # Handle temporary chats
             if chat_id == "local":
                 session_id = metadata.get("session_id")
                 chat_id = f"temporary-session-{session_id}"
 
-            metadata["chat_id"] = chat_id
-            body["metadata"] = metadata
+            # Only touch metadata when the value actually changes
+            if metadata.get("chat_id") != chat_id:
+                metadata["chat_id"] = chat_id
 
             base = self._base_log(body, user)
             base["event-type"] = "user_input"
 
-            if self.valves.include_content:
-                user_message = get_last_user_message(body["messages"])
-                base["additional-data"] = user_message
-            else:
-                base["additional-data"] = ""
+            # With content logging off, the messages list is never touched
+            # and the key is omitted from the line entirely
+            if self._include_content:
+                base["additional-data"] = get_last_user_message(body["messages"])
 
             self._print_log(base)
-        except Exception as e:
-            print(f"Error: {e}")
-            print(traceback.format_exc())
+        except Exception:
+            logger.exception("audit log failure")
             return body
         return body
 
     async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
         try:
-            metadata = body.get("metadata", {})
+            metadata = body.get("metadata")
+            if metadata is None:
+                metadata = {}
+                body["metadata"] = metadata
             chat_id = body.get("chat_id")
 
             # Handle temporary chats
@@ -138,21 +318,20 @@ class Pipeline:
                 session_id = body.get("session_id")
                 chat_id = f"temporary-session-{session_id}"
 
-            metadata["chat_id"] = chat_id
-            body["metadata"] = metadata
+            # Only touch metadata when the value actually changes
+            if metadata.get("chat_id") != chat_id:
+                metadata["chat_id"] = chat_id
 
             base = self._base_log(body, user)
             base["event-type"] = "llm_response"
 
-            if self.valves.include_content:
-                assistant_message = get_last_assistant_message(body["messages"])
-                base["additional-data"] = assistant_message
-            else:
-                base["additional-data"] = ""
+            # With content logging off, the messages list is never touched
+            # and the key is omitted from the line entirely
+            if self._include_content:
+                base["additional-data"] = get_last_assistant_message(body["messages"])
 
             self._print_log(base)
-        except Exception as e:
-            print(f"Error: {e}")
-            print(traceback.format_exc())
+        except Exception:
+            logger.exception("audit log failure")
             return body
         return body
@@ -8,21 +8,28 @@ description: Filter that enforces maximum input message length and caps/truncate
 """
 
 from typing import List, Optional, Any
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from schemas import OpenAIChatMessage
 import os
 import math
 
+# Environment is read once at import; Valves defaults reference these
+# constants instead of hitting os.environ on every instantiation.
+_PIPELINES = os.environ.get("MSG_LEN_FILTER_PIPELINES", "*").split(",")
+_MAX_USER_MESSAGE_CHARS = int(os.environ.get("MAX_USER_MESSAGE_CHARS", "4000"))
 
-def _get_last_message_by_roles(messages: List[dict], roles: List[str]) -> Optional[dict]:
-    for message in reversed(messages):
-        if message.get("role") in roles:
-            return message
-    return None
 
+def _get_last_message_by_roles(messages: List[dict], roles) -> Optional[dict]:
+    # frozenset membership is O(1); next() keeps the scan in the C-level
+    # iterator protocol instead of a Python for loop.
+    rs = roles if isinstance(roles, frozenset) else frozenset(roles)
+    return next((m for m in reversed(messages) if m.get("role") in rs), None)
 
-def _compute_text_length(content: Any) -> int:
+
+def _compute_text_length(content: Any, limit: Optional[int] = None) -> int:
     # content can be a string or a list (multi-part). We count only textual segments.
+    # If a limit is given, we stop summing as soon as it is exceeded so oversized
+    # inputs are rejected without walking the whole payload.
     if isinstance(content, str):
         return len(content)
     if isinstance(content, list):
@@ -35,21 +42,36 @@ def _compute_text_length(content: Any) -> int:
                 text = part.get("text") or part.get("content")
                 if isinstance(text, str):
                     total += len(text)
+            if limit is not None and total > limit:
+                return total
         return total
     return 0
 
 
 class Pipeline:
+    # Fixed attribute set: slot reads skip the instance __dict__ lookup on
+    # the hot path. The server only ever assigns `valves` from outside.
+    __slots__ = (
+        "type",
+        "name",
+        "valves",
+        "_target_roles",
+        "_desired_tokens",
+        "_max_chars",
+    )
+
     class Valves(BaseModel):
+        model_config = ConfigDict(frozen=True)
+
         # Connect to these pipelines (models). Use ["*"] for all.
-        pipelines: List[str] = ["*"]
+        pipelines: List[str] = _PIPELINES
 
         # Filter execution order among filters. Lower runs first.
         priority: int = 0
 
         # Input validation
         target_user_roles: List[str] = ["user"]
-        max_user_message_chars: Optional[int] = int(os.getenv("MAX_USER_MESSAGE_CHARS", "4000"))
+        max_user_message_chars: Optional[int] = _MAX_USER_MESSAGE_CHARS
 
         # Output limits
         # If set, we will constrain generation length via tokens only
@@ -60,36 +82,53 @@ class Pipeline:
         self.type = "filter"
         self.name = "Message Length Filter"
 
-        # Initialize valves with environment overrides where applicable
-        self.valves = self.Valves(
-            **{
-                "pipelines": os.getenv("MSG_LEN_FILTER_PIPELINES", "*").split(","),
-                # Other valves fall back to their defaults
-            }
-        )
+        self.valves = self.Valves()
+        self._refresh_from_valves()
+
+    def _refresh_from_valves(self):
+        # valves is replaced wholesale when config changes — via the update
+        # endpoint (on_valves_updated) or the valves.json load at startup
+        # (on_startup) — so every caching site must go through here.
+        self._target_roles = frozenset(self.valves.target_user_roles)
+        self._desired_tokens = self.valves.max_assistant_response_tokens
+        self._max_chars = self.valves.max_user_message_chars or 0
+
+    async def on_startup(self):
+        print(f"on_startup:{__name__}")
+        self._refresh_from_valves()
+
+    async def on_valves_updated(self):
+        self._refresh_from_valves()
 
     def _apply_output_token_cap(self, body: dict):
-        # Enforce explicit token cap only
-        desired_tokens = self.valves.max_assistant_response_tokens
-        if desired_tokens is None:
+        # Enforce explicit token cap only; no cap configured is the common
+        # case and returns after a single attribute read
+        dt = self._desired_tokens
+        if dt is None:
             return
 
         options = body.get("options")
         if not isinstance(options, dict):
             options = {}
-        options["max_tokens"] = min(options.get("max_tokens", desired_tokens), desired_tokens)
+        cur = options.get("max_tokens")
+        options["max_tokens"] = dt if cur is None else (cur if cur < dt else dt)
         body["options"] = options
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         # Validate input message length
-        max_chars = self.valves.max_user_message_chars
-        if max_chars and max_chars > 0:
-            last_target_msg = _get_last_message_by_roles(body.get("messages", []), self.valves.target_user_roles)
+        mc = self._max_chars
+        if mc > 0:
+            messages = body.get("messages")
+            last_target_msg = (
+                _get_last_message_by_roles(messages, self._target_roles)
+                if messages
+                else None
+            )
             if last_target_msg:
-                length = _compute_text_length(last_target_msg.get("content"))
-                if length > max_chars:
+                length = _compute_text_length(last_target_msg.get("content"), limit=mc)
+                if length > mc:
                     raise Exception(
-                        f"Input message exceeds limit: {length} > {max_chars} characters."
+                        f"Input message exceeds limit: {length} > {mc} characters."
                     )
 
         # Enforce output cap via tokens (top-level and options)